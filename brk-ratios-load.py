@@ -1,25 +1,10 @@
-import os
-import math
-import time
-import json
-from typing import List, Dict, Any, Union, Optional
-from datetime import datetime
-import requests
-from supabase import create_client, Client
-from dotenv import load_dotenv
+import sys
+from dataclasses import dataclass, fields
+from typing import List, Dict, Any, Optional
+from supabase import Client
+from fmp_common import STORE_RAW, probe_limits, run_loader
 
 
-load_dotenv()
-
-SUPABASE_URL = os.environ["SUPABASE_URL"]
-SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
-FMP_API_KEY = os.environ["FMP_API_KEY"]
-
-# Optional: guardrails
-for var in ["SUPABASE_URL", "SUPABASE_SERVICE_ROLE_KEY", "FMP_API_KEY"]:
-    if not os.getenv(var):
-        raise RuntimeError(f"Missing required env var: {var}")
-
 SYMBOL = "BRK-B"          # FMP uses BRK-B for Berkshire Class B  
 PERIOD = "quarter"
 LIMIT = 80                # Get many quarters of historical data
@@ -27,148 +12,142 @@ FMP_BASE = "https://financialmodelingprep.com/stable/ratios"
 
 TABLE = "financial_ratios"
 
-def fetch_fmp_ratios(symbol: str, apikey: str, period: str = "quarter", limit: int = 20) -> List[Dict[str, Any]]:
-    """Fetch financial ratios from FMP."""
-    url = (
-        f"{FMP_BASE}?symbol={symbol}"
-        f"&apikey={apikey}"
-        f"&period={period}"
-        f"&limit={limit}"
-    )
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    if not isinstance(data, list):
-        print(f"Warning: Unexpected FMP response type: {type(data)}")
-        print(f"Response: {data}")
-        return []
-    return data
-
-def normalize_row(row: Dict[str, Any]) -> Dict[str, Any]:
+def _safe_float(value: Any) -> Optional[float]:
+    """Safely convert value to float, return None if invalid."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+def _safe_int(value: Any) -> Optional[int]:
+    """Safely convert value to int, return None if invalid."""
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+@dataclass(slots=True)
+class RatioRow:
+    """One normalized financial_ratios row (one per quarter)."""
+    symbol: Optional[str]
+    date: Optional[str]  # Already ISO date (YYYY-MM-DD)
+    fiscal_year: Optional[int]
+    period: Optional[str]
+    reported_currency: Optional[str]
+
+    # Key ratios we're targeting
+    book_value_per_share: Optional[float]
+    price_to_book_ratio: Optional[float]
+
+    # Additional important ratios
+    price_to_earnings_ratio: Optional[float]
+    price_to_sales_ratio: Optional[float]
+    net_profit_margin: Optional[float]
+    gross_profit_margin: Optional[float]
+    operating_profit_margin: Optional[float]
+    debt_to_equity_ratio: Optional[float]
+    current_ratio: Optional[float]
+    quick_ratio: Optional[float]
+
+    # Per share metrics
+    revenue_per_share: Optional[float]
+    net_income_per_share: Optional[float]
+    cash_per_share: Optional[float]
+    free_cash_flow_per_share: Optional[float]
+
+    # Metadata
+    source: str = "FMP"
+    raw_data: Optional[Dict[str, Any]] = None  # Only sent when STORE_RAW=1
+
+# (our column, FMP field) pairs for every numeric ratio we store
+_FLOAT_FIELDS = (
+    # Key ratios we're targeting
+    ("book_value_per_share", "bookValuePerShare"),
+    ("price_to_book_ratio", "priceToBookRatio"),
+
+    # Additional important ratios
+    ("price_to_earnings_ratio", "priceToEarningsRatio"),
+    ("price_to_sales_ratio", "priceToSalesRatio"),
+    ("net_profit_margin", "netProfitMargin"),
+    ("gross_profit_margin", "grossProfitMargin"),
+    ("operating_profit_margin", "operatingProfitMargin"),
+    ("debt_to_equity_ratio", "debtToEquityRatio"),
+    ("current_ratio", "currentRatio"),
+    ("quick_ratio", "quickRatio"),
+
+    # Per share metrics
+    ("revenue_per_share", "revenuePerShare"),
+    ("net_income_per_share", "netIncomePerShare"),
+    ("cash_per_share", "cashPerShare"),
+    ("free_cash_flow_per_share", "freeCashFlowPerShare"),
+)
+
+# normalize_row builds RatioRow positionally, so the float columns must sit right after the
+# five leading fields, in exactly _FLOAT_FIELDS order
+if [f.name for f in fields(RatioRow)][5:5 + len(_FLOAT_FIELDS)] != [dst for dst, _ in _FLOAT_FIELDS]:
+    raise RuntimeError("_FLOAT_FIELDS is out of sync with RatioRow field order")
+
+def normalize_row(row: Dict[str, Any]) -> RatioRow:
     """Map FMP fields into our table schema (one row per quarter)."""
-    
-    def safe_float(value: Any) -> Optional[float]:
-        """Safely convert value to float, return None if invalid."""
-        if value is None or value == "":
-            return None
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return None
-    
-    def safe_int(value: Any) -> Optional[int]:
-        """Safely convert value to int, return None if invalid."""
-        if value is None or value == "":
-            return None
-        try:
-            return int(value)
-        except (ValueError, TypeError):
-            return None
-    
-    return {
-        "symbol": row.get("symbol"),
-        "date": row.get("date"),  # Already ISO date (YYYY-MM-DD)
-        "fiscal_year": safe_int(row.get("fiscalYear")),
-        "period": row.get("period"),
-        "reported_currency": row.get("reportedCurrency", "USD"),
-        
-        # Key ratios we're targeting
-        "book_value_per_share": safe_float(row.get("bookValuePerShare")),
-        "price_to_book_ratio": safe_float(row.get("priceToBookRatio")),
-        
-        # Additional important ratios
-        "price_to_earnings_ratio": safe_float(row.get("priceToEarningsRatio")),
-        "price_to_sales_ratio": safe_float(row.get("priceToSalesRatio")),
-        "net_profit_margin": safe_float(row.get("netProfitMargin")),
-        "gross_profit_margin": safe_float(row.get("grossProfitMargin")),
-        "operating_profit_margin": safe_float(row.get("operatingProfitMargin")),
-        "debt_to_equity_ratio": safe_float(row.get("debtToEquityRatio")),
-        "current_ratio": safe_float(row.get("currentRatio")),
-        "quick_ratio": safe_float(row.get("quickRatio")),
-        
-        # Per share metrics
-        "revenue_per_share": safe_float(row.get("revenuePerShare")),
-        "net_income_per_share": safe_float(row.get("netIncomePerShare")),
-        "cash_per_share": safe_float(row.get("cashPerShare")),
-        "free_cash_flow_per_share": safe_float(row.get("freeCashFlowPerShare")),
-        
-        # Metadata
-        "source": "FMP",
-        "raw_data": row,  # Store original payload for audit/debug
-    }
-
-def chunked(iterable: List[Dict[str, Any]], size: int = 500):
-    for i in range(0, len(iterable), size):
-        yield iterable[i:i+size]
-
-def upsert_rows(sb: Client, rows: List[Dict[str, Any]]):
-    """Upsert into Supabase with unique(symbol, date)."""
-    if not rows:
-        return
-    for batch in chunked(rows, 500):
-        # Upsert with conflict target "symbol,date"
-        (
-            sb.table(TABLE)
-              .upsert(batch, on_conflict="symbol,date", ignore_duplicates=False)
-              .execute()
-        )
+    g = row.get
+    _sf = _safe_float
+
+    return RatioRow(
+        g("symbol"),
+        g("date"),
+        _safe_int(g("fiscalYear")),
+        g("period"),
+        g("reportedCurrency", "USD"),
+        *[_sf(g(src)) for _, src in _FLOAT_FIELDS],
+        "FMP",
+        row if STORE_RAW else None,  # Store original payload for audit/debug
+    )
+
+def _describe(data: List[Dict[str, Any]]):
+    # Show sample of key ratios
+    latest = data[0]
+    print(f"Latest BVPS: ${latest.get('bookValuePerShare', 'N/A')}")
+    print(f"Latest P/B: {latest.get('priceToBookRatio', 'N/A')}")
 
 def test_api_endpoints():
     """Test different API endpoints to find current data."""
-    
-    # Test different limits to see data availability
-    for limit in [10, 20, 40, 80]:
-        print(f"\n--- Testing limit={limit} ---")
-        try:
-            data = fetch_fmp_ratios(SYMBOL, FMP_API_KEY, PERIOD, limit)
-            if data:
-                print(f"Got {len(data)} records")
-                print(f"Date range: {data[-1]['date']} to {data[0]['date']}")
-                # Show sample of key ratios
-                latest = data[0]
-                print(f"Latest BVPS: ${latest.get('bookValuePerShare', 'N/A')}")
-                print(f"Latest P/B: {latest.get('priceToBookRatio', 'N/A')}")
-            else:
-                print("No data returned")
-        except Exception as e:
-            print(f"Error: {e}")
-
-def main():
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    probe_limits(FMP_BASE, SYMBOL, PERIOD, describe=_describe)
 
+def main(supabase: Optional[Client] = None, full: bool = False):
     # Uncomment to test API endpoints
     # test_api_endpoints()
     # return
 
     print(f"Fetching FMP financial ratios for {SYMBOL} (period={PERIOD}, limit={LIMIT})...")
-    data = fetch_fmp_ratios(SYMBOL, FMP_API_KEY, PERIOD, LIMIT)
-    
-    print(f"Fetched {len(data)} quarters of ratios data")
-
-    # Normalize and keep only fields we care about (plus raw)
-    rows = [normalize_row(r) for r in data]
+    supabase = run_loader(FMP_BASE, TABLE, normalize_row, SYMBOL, PERIOD, LIMIT, sb=supabase, full=full)
 
-    # Optional: filter out rows missing essential fields
-    rows = [r for r in rows if r.get("symbol") and r.get("date")]
-    print(f"Processed {len(rows)} valid records")
-
-    print(f"Upserting {len(rows)} rows into {TABLE}...")
-    upsert_rows(supabase, rows)
-    print("Done.")
-
-    # Quick sanity check: show date range and sample values
+    # Quick sanity check: show date range and sample values (small targeted queries, not a full scan)
+    oldest = (
+        supabase.table(TABLE)
+        .select("date")
+        .eq("symbol", SYMBOL)
+        .order("date", desc=False)
+        .limit(1)
+        .execute()
+    )
     res = (
         supabase.table(TABLE)
         .select("symbol,date,period,fiscal_year,book_value_per_share,price_to_book_ratio")
         .eq("symbol", SYMBOL)
-        .order("date", desc=False)  # Get oldest to newest
+        .order("date", desc=True)  # Newest first so we only pull the last 5 records
+        .limit(5)
         .execute()
     )
-    
-    if res.data:
-        print(f"\nStored data range: {res.data[0]['date']} to {res.data[-1]['date']}")
+
+    if oldest.data and res.data:
+        recent = list(reversed(res.data))  # Oldest to newest
+        print(f"\nStored data range: {oldest.data[0]['date']} to {recent[-1]['date']}")
         print("Sample recent ratios:")
-        for r in res.data[-5:] or []:  # Show last 5 records
+        for r in recent:
             bvps = r.get('book_value_per_share')
             pb = r.get('price_to_book_ratio')
             bvps_str = f"${bvps:.2f}" if bvps is not None else "N/A"
@@ -178,4 +157,5 @@ def main():
         print("No data found in database")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Pass --full to re-upsert every fetched quarter (backfill)
+    main(full="--full" in sys.argv[1:])
@@ -0,0 +1,445 @@
+import os
+import atexit
+import asyncio
+import threading
+import importlib.util
+from dataclasses import fields, is_dataclass
+from functools import lru_cache
+from operator import attrgetter, itemgetter
+from typing import List, Dict, Any, Callable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json if the orjson wheel isn't installed
+    import json as orjson
+try:
+    import zstandard
+except ImportError:  # cache files are written uncompressed without zstandard
+    zstandard = None
+try:
+    import psycopg
+    from psycopg import sql
+    from psycopg.types.json import Jsonb
+except ImportError:  # upserts fall back to PostgREST without psycopg
+    psycopg = None
+try:
+    import httpx
+except ImportError:  # only needed for the async multi-symbol path (run_many)
+    httpx = None
+from supabase import create_client, Client
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+REQUIRED = ("SUPABASE_URL", "SUPABASE_SERVICE_ROLE_KEY", "FMP_API_KEY")
+
+# Read and validate all required env vars (from .env) in one pass
+try:
+    SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, FMP_API_KEY = itemgetter(*REQUIRED)(os.environ)
+except KeyError as e:
+    raise RuntimeError(f"Missing required env var: {e.args[0]}") from None
+for var, value in zip(REQUIRED, (SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, FMP_API_KEY)):
+    if not value:
+        raise RuntimeError(f"Missing required env var: {var}")
+
+# Set STORE_RAW=1 to also persist the original FMP payload (roughly doubles upsert payload size)
+STORE_RAW = os.getenv("STORE_RAW", "0") == "1"
+
+# HTTP statuses worth retrying with backoff (rate limiting and transient server errors)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Reuse one pooled, keep-alive session for all FMP calls (avoids a TLS handshake per request)
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=10,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=RETRY_STATUSES),
+    ),
+)
+
+# Optional direct Postgres connection string; when set (and psycopg is installed)
+# upserts go through COPY into a staging table instead of PostgREST
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+
+# One direct connection per process, opened lazily; the lock serializes COPY upserts on it
+# so concurrent loaders (run_many) never open more than one Postgres connection
+_DB_CONN = None
+_DB_LOCK = threading.Lock()
+
+# On-disk cache of FMP responses, revalidated with ETag / Last-Modified
+CACHE_DIR = os.getenv("FMP_CACHE_DIR", ".cache")
+
+def get_client() -> Client:
+    """Create a Supabase client from the env config."""
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+
+def fetch(endpoint: str, **params: Any) -> List[Dict[str, Any]]:
+    """GET an FMP endpoint over the shared session and return the list payload."""
+    resp = _SESSION.get(endpoint, params=params, timeout=30)
+    resp.raise_for_status()
+    return _as_list(orjson.loads(resp.content))
+
+def _as_list(data: Any) -> List[Dict[str, Any]]:
+    if not isinstance(data, list):
+        print(f"Warning: Unexpected FMP response type: {type(data)}")
+        print(f"Response: {data}")
+        return []
+    return data
+
+def _cache_paths(endpoint: str, table: str, params: Dict[str, Any]) -> Tuple[str, str]:
+    name = endpoint.rstrip("/").rsplit("/", 1)[-1]
+    key = "_".join(str(params[k]) for k in ("symbol", "period", "limit") if k in params)
+    body_path = os.path.join(CACHE_DIR, f"{table}_{name}_{key}.json" + (".zst" if zstandard else ""))
+    return body_path, body_path + ".meta"
+
+# (body_path, meta_path, content, etag, last_modified) for a response not yet written to the cache
+CacheEntry = Tuple[str, str, bytes, str, str]
+
+def fetch_cached(
+    endpoint: str,
+    table: str,
+    conditional: bool = True,
+    **params: Any,
+) -> Tuple[List[Dict[str, Any]], bool, Optional[CacheEntry]]:
+    """Like fetch(), but sends a conditional GET using the ETag/Last-Modified cached for table.
+
+    With conditional=False the validators are not sent, so the response is always a full 200.
+
+    Returns (data, changed, entry); changed is False when FMP answered 304 and data came from disk.
+    Nothing is written here: pass entry to write_cache() once the data has been stored.
+    """
+    body_path, meta_path = _cache_paths(endpoint, table, params)
+
+    headers = {}
+    if conditional and os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path, "r") as fh:
+            etag, _, last_modified = fh.read().partition("\n")
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    resp = _SESSION.get(endpoint, params=params, headers=headers, timeout=30)
+    if resp.status_code == 304:
+        with open(body_path, "rb") as fh:
+            content = fh.read()
+        if zstandard:
+            content = zstandard.ZstdDecompressor().decompress(content)
+        return _as_list(orjson.loads(content)), False, None
+
+    resp.raise_for_status()
+    data = _as_list(orjson.loads(resp.content))
+
+    etag = resp.headers.get("ETag", "")
+    last_modified = resp.headers.get("Last-Modified", "")
+    entry = (body_path, meta_path, resp.content, etag, last_modified) if data and (etag or last_modified) else None
+    return data, True, entry
+
+def write_cache(entry: Optional[CacheEntry]):
+    """Persist a response returned by fetch_cached() so the next run can revalidate it."""
+    if entry is None:
+        return
+    body_path, meta_path, content, etag, last_modified = entry
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if zstandard:
+        content = zstandard.ZstdCompressor().compress(content)
+    with open(body_path, "wb") as fh:
+        fh.write(content)
+    with open(meta_path, "w") as fh:
+        fh.write(f"{etag}\n{last_modified}")
+
+# Columns holding the original FMP payload; left out of upserts unless STORE_RAW=1
+RAW_FIELDS = ("raw", "raw_data")
+
+@lru_cache(maxsize=None)
+def _row_columns(row_cls: type) -> Tuple[str, ...]:
+    return tuple(f.name for f in fields(row_cls) if STORE_RAW or f.name not in RAW_FIELDS)
+
+def as_row_dicts(rows: List[Any]) -> List[Dict[str, Any]]:
+    """Convert dataclass rows (e.g. RatioRow) to plain dicts for PostgREST; dict rows pass through."""
+    if not rows or not is_dataclass(rows[0]):
+        return rows
+    cols = _row_columns(type(rows[0]))
+    get_values = attrgetter(*cols)
+    return [dict(zip(cols, get_values(r))) for r in rows]
+
+def chunked(iterable: List[Dict[str, Any]], size: int = 500):
+    for i in range(0, len(iterable), size):
+        yield iterable[i:i+size]
+
+def batch_size_for(rows: List[Dict[str, Any]], target_bytes: int = 8 * 1024 * 1024, max_rows: int = 1000) -> int:
+    """Pick a batch size that keeps each upsert request around target_bytes."""
+    estimated_row_bytes = len(orjson.dumps(rows[0]))
+    return max(1, min(max_rows, target_bytes // max(1, estimated_row_bytes)))
+
+def _db_conn() -> "psycopg.Connection":
+    """Return the shared direct Postgres connection, (re)opening it if needed. Call with _DB_LOCK held."""
+    global _DB_CONN
+    if _DB_CONN is None or _DB_CONN.closed:
+        # autocommit so each conn.transaction() block is its own explicit BEGIN/COMMIT
+        _DB_CONN = psycopg.connect(SUPABASE_DB_URL, autocommit=True)
+        atexit.register(_DB_CONN.close)
+    return _DB_CONN
+
+def _row_values(row: Any, cols: List[str]) -> List[Any]:
+    # Dataclass rows are read by attribute, so no per-row dicts are needed
+    if is_dataclass(row):
+        values = [getattr(row, c) for c in cols]
+    else:
+        values = [row.get(c) for c in cols]
+    return [Jsonb(v) if isinstance(v, dict) else v for v in values]
+
+def copy_upsert_rows(table: str, rows: List[Any]):
+    """Bulk upsert over a direct Postgres connection: COPY into a temp table, then INSERT ... ON CONFLICT."""
+    if is_dataclass(rows[0]):
+        cols = list(_row_columns(type(rows[0])))
+    else:
+        cols = list(rows[0].keys())
+    col_ids = sql.SQL(", ").join(map(sql.Identifier, cols))
+    updates = sql.SQL(", ").join(
+        sql.SQL("{c} = EXCLUDED.{c}").format(c=sql.Identifier(c))
+        for c in cols if c not in ("symbol", "date")
+    )
+
+    with _DB_LOCK:
+        conn = _db_conn()
+        with conn.transaction():
+            cur = conn.cursor()
+            cur.execute("SET LOCAL synchronous_commit = OFF")
+            # Stage only the upserted columns: copying the table's defaults (e.g. a serial id)
+            # would burn a sequence value per staged row on top of the one the INSERT takes
+            cur.execute(
+                sql.SQL("CREATE TEMP TABLE _stage ON COMMIT DROP AS SELECT {cols} FROM {t} WITH NO DATA")
+                .format(cols=col_ids, t=sql.Identifier(table))
+            )
+            with cur.copy(sql.SQL("COPY _stage ({}) FROM STDIN").format(col_ids)) as copy:
+                for r in rows:
+                    copy.write_row(_row_values(r, cols))
+            cur.execute(
+                sql.SQL(
+                    "INSERT INTO {t} ({cols}) SELECT {cols} FROM _stage "
+                    "ON CONFLICT (symbol, date) DO UPDATE SET {updates}"
+                ).format(t=sql.Identifier(table), cols=col_ids, updates=updates)
+            )
+
+def upsert_rows(sb: Client, table: str, rows: List[Any]):
+    """Upsert into Supabase with unique(symbol, date). Rows may be dicts or dataclasses."""
+    if not rows:
+        return
+    if SUPABASE_DB_URL and psycopg is not None:
+        copy_upsert_rows(table, rows)
+        return
+    rows = as_row_dicts(rows)
+    size = batch_size_for(rows)
+    if len(rows) <= size:
+        # Common case: everything fits in one request
+        sb.table(table).upsert(rows, on_conflict="symbol,date", ignore_duplicates=False).execute()
+        return
+    for batch in chunked(rows, size):
+        # Upsert with conflict target "symbol,date"
+        (
+            sb.table(table)
+              .upsert(batch, on_conflict="symbol,date", ignore_duplicates=False)
+              .execute()
+        )
+
+def latest_stored_date(sb: Client, table: str, symbol: str) -> str:
+    """Return the newest date already stored for symbol, or "" if there are none."""
+    res = (
+        sb.table(table)
+        .select("date")
+        .eq("symbol", symbol)
+        .order("date", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return res.data[0]["date"] if res.data else ""
+
+def only_new(data: List[Dict[str, Any]], max_date: str) -> List[Dict[str, Any]]:
+    """Keep records on/after max_date (the latest stored quarter is re-sent in case FMP revised it)."""
+    return [r for r in data if (r.get("date") or "") >= max_date]
+
+def probe_limits(
+    endpoint: str,
+    symbol: str,
+    period: str,
+    describe: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+):
+    """Probe an endpoint at several limits to see how far back data goes."""
+
+    def _probe(limit: int):
+        try:
+            return limit, fetch(endpoint, symbol=symbol, apikey=FMP_API_KEY, period=period, limit=limit), None
+        except Exception as e:
+            return limit, None, e
+
+    # Test different limits to see data availability (requests run concurrently)
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        results = list(ex.map(_probe, [10, 20, 40, 80]))
+
+    for limit, data, err in results:
+        print(f"\n--- Testing limit={limit} ---")
+        if err is not None:
+            print(f"Error: {err}")
+        elif data:
+            print(f"Got {len(data)} records")
+            print(f"Date range: {data[-1]['date']} to {data[0]['date']}")
+            if describe:
+                describe(data)
+        else:
+            print("No data returned")
+
+def normalize_and_upsert(
+    sb: Client,
+    table: str,
+    normalize_fn: Callable[[Dict[str, Any]], Any],
+    data: List[Dict[str, Any]],
+) -> int:
+    """Normalize fetched FMP records and upsert them; returns the number of rows upserted."""
+    # Skip rows missing date/symbol before paying for normalization,
+    # then keep only fields we care about (plus raw if STORE_RAW)
+    rows = [normalize_fn(r) for r in data if r.get("symbol") and r.get("date")]
+    upsert_rows(sb, table, rows)
+    return len(rows)
+
+def run_loader(
+    endpoint_url: str,
+    table: str,
+    normalize_fn: Callable[[Dict[str, Any]], Any],
+    symbol: str,
+    period: str = "quarter",
+    limit: int = 20,
+    sb: Optional[Client] = None,
+    full: bool = False,
+) -> Client:
+    """Fetch one symbol from FMP, normalize it and upsert into table. Returns the client used.
+
+    Unless full=True, only quarters newer than what's already stored are upserted, and an
+    unchanged (304) FMP response skips the upsert entirely. full=True always fetches and upserts everything.
+    """
+    if sb is None:
+        sb = get_client()
+
+    data, changed, cache_entry = fetch_cached(
+        endpoint_url, table, conditional=not full,
+        symbol=symbol, apikey=FMP_API_KEY, period=period, limit=limit,
+    )
+    if not changed:
+        print(f"FMP data unchanged since last run ({len(data)} cached quarters); skipping upsert.")
+        return sb
+    print(f"Fetched {len(data)} quarters of data")
+
+    # Only look up what's stored once we know there is new data to compare against
+    max_date = "" if full else latest_stored_date(sb, table, symbol)
+    if max_date:
+        data = only_new(data, max_date)
+        print(f"Keeping quarters on/after latest stored date {max_date} (use --full to reload all)")
+
+    print(f"Upserting into {table}...")
+    count = normalize_and_upsert(sb, table, normalize_fn, data)
+    # Only remember the response once it's stored, so a failed upsert is retried next run
+    write_cache(cache_entry)
+    print(f"Done. Upserted {count} valid records.")
+    return sb
+
+async def fetch_async(
+    client: "httpx.AsyncClient",
+    endpoint: str,
+    retries: int = 3,
+    backoff_factor: float = 0.3,
+    **params: Any,
+) -> List[Dict[str, Any]]:
+    """Async counterpart of fetch() for use with a shared httpx.AsyncClient.
+
+    Retries RETRY_STATUSES and connection errors with exponential backoff, like the sync session.
+    """
+    for attempt in range(retries + 1):
+        try:
+            resp = await client.get(endpoint, params=params)
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                resp.raise_for_status()
+                return _as_list(orjson.loads(resp.content))
+        await asyncio.sleep(backoff_factor * (2 ** attempt))
+
+async def run_loader_async(
+    client: "httpx.AsyncClient",
+    fmp_limit: asyncio.Semaphore,
+    endpoint_url: str,
+    table: str,
+    normalize_fn: Callable[[Dict[str, Any]], Any],
+    symbol: str,
+    period: str,
+    limit: int,
+    sb: Client,
+    full: bool = False,
+) -> int:
+    """Fetch, normalize and upsert one symbol; returns the number of rows upserted."""
+    max_date = "" if full else await asyncio.to_thread(latest_stored_date, sb, table, symbol)
+    async with fmp_limit:
+        data = await fetch_async(client, endpoint_url, symbol=symbol, apikey=FMP_API_KEY, period=period, limit=limit)
+    if max_date:
+        data = only_new(data, max_date)
+
+    # supabase-py is sync, so run the upsert in a worker thread while other fetches proceed
+    count = await asyncio.to_thread(normalize_and_upsert, sb, table, normalize_fn, data)
+    print(f"{symbol}: upserted {count} rows into {table}")
+    return count
+
+def _describe_error(err: Exception) -> str:
+    # httpx error messages embed the request URL, which carries apikey=...; never print those
+    if httpx is not None and isinstance(err, httpx.HTTPStatusError):
+        return f"HTTP {err.response.status_code}"
+    if httpx is not None and isinstance(err, httpx.RequestError):
+        return type(err).__name__
+    return str(err).replace(FMP_API_KEY, "***")
+
+async def run_many(
+    endpoint_url: str,
+    table: str,
+    normalize_fn: Callable[[Dict[str, Any]], Any],
+    symbols: List[str],
+    period: str = "quarter",
+    limit: int = 20,
+    sb: Optional[Client] = None,
+    concurrency: int = 4,
+    full: bool = False,
+) -> int:
+    """Load many symbols concurrently, overlapping FMP fetches with Supabase upserts.
+
+    A failing symbol is reported and skipped rather than aborting the rest of the batch.
+    Returns the total number of rows upserted.
+    """
+    if httpx is None:
+        raise RuntimeError("run_many requires httpx (pip install 'httpx[http2]')")
+    if sb is None:
+        sb = get_client()
+
+    fmp_limit = asyncio.Semaphore(concurrency)
+    http2 = importlib.util.find_spec("h2") is not None
+    async with httpx.AsyncClient(http2=http2, timeout=30) as client:
+        results = await asyncio.gather(*[
+            run_loader_async(client, fmp_limit, endpoint_url, table, normalize_fn, sym, period, limit, sb, full)
+            for sym in symbols
+        ], return_exceptions=True)
+
+    total = 0
+    failed = []
+    for sym, result in zip(symbols, results):
+        if isinstance(result, Exception):
+            print(f"{sym}: failed to load into {table}: {_describe_error(result)}")
+            failed.append(sym)
+        else:
+            total += result
+    if failed:
+        print(f"{len(failed)} of {len(symbols)} symbols failed for {table}: {', '.join(failed)}")
+    return total
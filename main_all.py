@@ -0,0 +1,36 @@
+import asyncio
+import importlib
+import sys
+from fmp_common import get_client, run_many
+
+# The loader scripts have hyphenated filenames, so load them via importlib
+cfs_loader = importlib.import_module("brk-cfs-load")
+ratios_loader = importlib.import_module("brk-ratios-load")
+
+
+def main(full: bool = False):
+    # One Supabase client and one pooled FMP session shared by both loaders
+    supabase = get_client()
+    cfs_loader.main(supabase, full=full)
+    print()
+    ratios_loader.main(supabase, full=full)
+
+async def main_async(symbols, full: bool = False):
+    """Load both tables for many symbols with overlapping fetches and upserts."""
+    supabase = get_client()
+    for loader in (cfs_loader, ratios_loader):
+        total = await run_many(
+            loader.FMP_BASE, loader.TABLE, loader.normalize_row, symbols,
+            loader.PERIOD, loader.LIMIT, sb=supabase, full=full,
+        )
+        print(f"Upserted {total} rows into {loader.TABLE}")
+
+if __name__ == "__main__":
+    # e.g. `python main_all.py BRK-B AAPL MSFT` for a multi-symbol run; add --full to backfill
+    args = sys.argv[1:]
+    full = "--full" in args
+    symbols = [a for a in args if a != "--full"]
+    if symbols:
+        asyncio.run(main_async(symbols, full=full))
+    else:
+        main(full=full)